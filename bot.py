@@ -1,9 +1,13 @@
 import os
 import re
+import html
+import time
 import asyncio
-from typing import Optional, Tuple, List
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, List
 
 import asyncpg
+from aiolimiter import AsyncLimiter
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
@@ -12,11 +16,18 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ChatJoinRequest,
+    LinkPreviewOptions,
 )
 from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import SendMessage, SendVideo
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+try:
+    import uvloop  # Windowsda yo'q — oddiy asyncio loop ishlatiladi
+except ImportError:
+    uvloop = None
+
 
 # ======================
 # CONFIG (Railway Variables)
@@ -27,6 +38,9 @@ DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
 CHANNEL_INVITE = os.getenv("CHANNEL_INVITE", "https://t.me/+JBZQtaUKyRFiYmQy").strip()
 CHANNEL_ID = os.getenv("CHANNEL_ID", "").strip()  # -100... yoki @username (tavsiya: -100...)
 
+PG_POOL_MIN_RAW = os.getenv("PG_POOL_MIN", "5").strip()
+PG_POOL_MAX_RAW = os.getenv("PG_POOL_MAX", "25").strip()
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN topilmadi. Railway Variables ga BOT_TOKEN qo'ying.")
 if not DATABASE_URL:
@@ -34,6 +48,25 @@ if not DATABASE_URL:
 if not CHANNEL_ID:
     raise RuntimeError("CHANNEL_ID topilmadi. Railway Variables ga CHANNEL_ID qo'ying (masalan: -100...).")
 
+try:
+    PG_POOL_MIN = int(PG_POOL_MIN_RAW)
+except ValueError:
+    raise RuntimeError(f"PG_POOL_MIN butun son bo'lishi kerak (hozir: {PG_POOL_MIN_RAW!r}). Railway Variables ni tekshiring.") from None
+try:
+    PG_POOL_MAX = int(PG_POOL_MAX_RAW)
+except ValueError:
+    raise RuntimeError(f"PG_POOL_MAX butun son bo'lishi kerak (hozir: {PG_POOL_MAX_RAW!r}). Railway Variables ni tekshiring.") from None
+
+if PG_POOL_MIN < 0:
+    raise RuntimeError(f"PG_POOL_MIN ({PG_POOL_MIN}) manfiy bo'lmasin. Railway Variables ni tekshiring.")
+if PG_POOL_MAX < 1:
+    raise RuntimeError(f"PG_POOL_MAX ({PG_POOL_MAX}) kamida 1 bo'lishi kerak. Railway Variables ni tekshiring.")
+if PG_POOL_MIN > PG_POOL_MAX:
+    raise RuntimeError(
+        f"PG_POOL_MIN ({PG_POOL_MIN}) PG_POOL_MAX ({PG_POOL_MAX}) dan katta. "
+        "Railway Variables da PG_POOL_MIN <= PG_POOL_MAX qilib qo'ying."
+    )
+
 try:
     CHANNEL_ID_CAST = int(CHANNEL_ID)
 except ValueError:
@@ -46,12 +79,51 @@ except ValueError:
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
 
+# Telegram global limiti ~30 xabar/soniya — 429 (RetryAfter) olmaslik uchun navbatga qo'yamiz
+SEND_LIMITER = AsyncLimiter(25, 1)
+
+@bot.session.middleware()
+async def send_rate_limit(make_request, api_bot, method):
+    if isinstance(method, (SendMessage, SendVideo)):
+        async with SEND_LIMITER:
+            return await make_request(api_bot, method)
+    return await make_request(api_bot, method)
+
+
+# ======================
+# SO'ROVLARNI BIRLASHTIRISH
+# ======================
+async def coalesce(inflight: Dict[Any, "asyncio.Future"], key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Bir xil kalit bo'yicha parallel so'rovlar bitta chaqiruvni kutadi.
+    shield — bitta kutuvchi bekor qilinsa, qolganlari uchun so'rov davom etadi.
+    """
+    fut = inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(factory())
+        inflight[key] = fut
+        fut.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
 
 # ======================
 # DB (Postgres)
 # ======================
 pool: Optional[asyncpg.Pool] = None
 
+# code -> (title, kind, payload); kinolar kam o'zgaradi, shuning uchun xotirada saqlaymiz
+MOVIE_CACHE_SIZE = 1024
+_movie_cache: "OrderedDict[str, Tuple[str, str, str]]" = OrderedDict()
+_movie_inflight: Dict[Tuple[str, int], "asyncio.Future"] = {}
+
+# Har upsert_movie da oshadi. SELECT kutilayotganda yozuv bo'lsa,
+# eski natija keshlarga (LRU va sahifalar) yozilmaydi
+_movies_version = 0
+
+# Tayyor HTML sahifalar; ro'yxat faqat upsert_movie da o'zgaradi
+_movie_pages: Optional[List[str]] = None
+_movies_inflight: Dict[int, "asyncio.Future"] = {}
+
 CREATE_SQL = """
 CREATE TABLE IF NOT EXISTS movies (
     code TEXT PRIMARY KEY,
@@ -60,13 +132,26 @@ CREATE TABLE IF NOT EXISTS movies (
     payload TEXT NOT NULL,       -- url yoki video file_id
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
+
+-- list_movies uchun index-only scan (heapga bormasdan code, title)
+CREATE INDEX IF NOT EXISTS movies_code_title_idx ON movies(code) INCLUDE (title);
 """
 
 async def init_db():
     global pool
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    # Prepared statementlar ulanish yopilguncha keshda qoladi
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=PG_POOL_MIN,
+        max_size=PG_POOL_MAX,
+        command_timeout=10,
+        max_cached_statement_lifetime=0,
+        # Kichik so'rovlar uchun JIT faqat vaqt oladi
+        server_settings={"application_name": "moviebot", "jit": "off"},
+    )
     async with pool.acquire() as conn:
         await conn.execute(CREATE_SQL)
+        await conn.execute("ANALYZE movies")
 
 async def close_db():
     global pool
@@ -75,79 +160,139 @@ async def close_db():
         pool = None
 
 async def upsert_movie(code: str, title: str, kind: str, payload: str):
-    assert pool is not None
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO movies(code, title, kind, payload)
-            VALUES($1, $2, $3, $4)
-            ON CONFLICT(code) DO UPDATE SET
-                title = EXCLUDED.title,
-                kind = EXCLUDED.kind,
-                payload = EXCLUDED.payload,
-                created_at = NOW();
-            """,
-            code, title, kind, payload
-        )
+    global _movie_pages, _movies_version
+    await pool.execute(
+        """
+        INSERT INTO movies(code, title, kind, payload)
+        VALUES($1, $2, $3, $4)
+        ON CONFLICT(code) DO UPDATE SET
+            title = EXCLUDED.title,
+            kind = EXCLUDED.kind,
+            payload = EXCLUDED.payload,
+            created_at = NOW();
+        """,
+        code, title, kind, payload
+    )
+    _movie_cache.pop(code, None)
+    _movie_pages = None
+    _movies_version += 1
 
 async def get_movie(code: str) -> Optional[Tuple[str, str, str]]:
-    assert pool is not None
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT title, kind, payload FROM movies WHERE code=$1",
-            code
-        )
-        if not row:
-            return None
-        return row["title"], row["kind"], row["payload"]
+    cached = _movie_cache.get(code)
+    if cached is not None:
+        _movie_cache.move_to_end(code)
+        return cached
+
+    # Mashhur kod ko'p chatda bir vaqtda so'ralsa — bitta SELECT
+    return await coalesce(_movie_inflight, (code, _movies_version), lambda: _fetch_movie(code))
+
+async def _fetch_movie(code: str) -> Optional[Tuple[str, str, str]]:
+    version = _movies_version
+    row = await pool.fetchrow(
+        "SELECT title, kind, payload FROM movies WHERE code=$1",
+        code
+    )
+    if not row:
+        return None
+
+    movie = (row["title"], row["kind"], row["payload"])
+    if version == _movies_version:
+        _movie_cache[code] = movie
+        if len(_movie_cache) > MOVIE_CACHE_SIZE:
+            _movie_cache.popitem(last=False)
+    return movie
 
 async def list_movies() -> List[Tuple[str, str]]:
-    assert pool is not None
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT code, title FROM movies ORDER BY code ASC")
-        return [(r["code"], r["title"]) for r in rows]
+    rows = await pool.fetch("SELECT code, title FROM movies ORDER BY code ASC")
+    return [(r["code"], r["title"]) for r in rows]
+
+async def movie_pages() -> List[str]:
+    if _movie_pages is not None:
+        return _movie_pages
+    return await coalesce(_movies_inflight, _movies_version, _build_movie_pages)
+
+async def _build_movie_pages() -> List[str]:
+    global _movie_pages
+    version = _movies_version
+    pages = render_movie_pages(await list_movies())
+    if version == _movies_version:
+        _movie_pages = pages
+    return pages
 
 
 # ======================
 # UI
 # ======================
-def main_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🎬 Barcha kinolar", callback_data="all_movies")],
-        ]
-    )
+# Klaviaturalar o'zgarmaydi — bir marta yasab, qayta ishlatamiz
+MAIN_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="🎬 Barcha kinolar", callback_data="all_movies")],
+    ]
+)
 
-def join_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Kanalga a’zo bo‘lish", url=CHANNEL_INVITE)],
-            [InlineKeyboardButton(text="✅ Tekshirish", callback_data="check_sub")],
-        ]
-    )
+JOIN_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Kanalga a’zo bo‘lish", url=CHANNEL_INVITE)],
+        [InlineKeyboardButton(text="✅ Tekshirish", callback_data="check_sub")],
+    ]
+)
 
 
 # ======================
 # SUBSCRIPTION CHECK
 # ======================
-async def is_subscribed(user_id: int) -> bool:
+# user_id -> (a'zomi, tugash vaqti); har xabarda getChatMember chaqirmaslik uchun
+SUB_TTL = 180
+SUB_NEG_TTL = 30  # yangi a'zo bo'lganlar uzoq kutib qolmasin
+SUB_CACHE_SIZE = 10_000
+_sub_cache: Dict[int, Tuple[bool, float]] = {}
+_sub_inflight: Dict[int, "asyncio.Future"] = {}
+
+def remember_subscription(user_id: int, ok: bool):
+    now = time.monotonic()
+    if len(_sub_cache) >= SUB_CACHE_SIZE:
+        for uid in [uid for uid, (_, exp) in _sub_cache.items() if exp <= now]:
+            del _sub_cache[uid]
+        if len(_sub_cache) >= SUB_CACHE_SIZE:
+            _sub_cache.clear()
+    _sub_cache[user_id] = (ok, now + (SUB_TTL if ok else SUB_NEG_TTL))
+
+def cached_subscription(user_id: int) -> Optional[bool]:
+    cached = _sub_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+async def is_subscribed(user_id: int, fresh: bool = False) -> bool:
     """
     Private kanal bo'lsa bot admin bo'lishi shart.
     Ba'zan status 'restricted' bo'lishi mumkin — is_member=True bo'lsa a'zo hisoblaymiz.
+    fresh=True bo'lsa keshga qaramay Telegramdan qayta so'raymiz.
     """
-    try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID_CAST, user_id=user_id)
+    if not fresh:
+        cached = cached_subscription(user_id)
+        if cached is not None:
+            return cached
 
-        if member.status in ("creator", "administrator", "member"):
-            return True
+    # Bir foydalanuvchidan bir vaqtda kelgan updatelar bitta getChatMember ni kutadi
+    return await coalesce(_sub_inflight, user_id, lambda: _fetch_subscription(user_id))
 
-        if member.status == "restricted":
-            return bool(getattr(member, "is_member", False))
-
-        return False
+async def _fetch_subscription(user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(chat_id=CHANNEL_ID_CAST, user_id=user_id)
     except Exception:
         return False
 
+    if member.status in ("creator", "administrator", "member"):
+        ok = True
+    elif member.status == "restricted":
+        ok = bool(getattr(member, "is_member", False))
+    else:
+        ok = False
+
+    remember_subscription(user_id, ok)
+    return ok
+
 async def require_subscribed(message: Message) -> bool:
     user_id = message.from_user.id if message.from_user else 0
     if not user_id:
@@ -158,7 +303,7 @@ async def require_subscribed(message: Message) -> bool:
             "❗ Botdan foydalanish uchun avval kanalga a’zo bo‘ling.\n"
             "Agar kanalda 'request' bo'lsa, request yuboring — bot avtomatik tasdiqlaydi.\n"
             "So‘ng ✅ Tekshirish bosing.",
-            reply_markup=join_kb()
+            reply_markup=JOIN_KB
         )
     return ok
 
@@ -178,6 +323,7 @@ async def on_join_request(req: ChatJoinRequest):
             return
 
         await bot.approve_chat_join_request(chat_id=req.chat.id, user_id=req.from_user.id)
+        remember_subscription(req.from_user.id, True)
 
         # Foydalanuvchiga DM (agar yoqilgan bo'lsa)
         try:
@@ -200,18 +346,49 @@ class AddMovie(StatesGroup):
     title = State()
     content = State()
 
-CODE_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+CODE_MAX_LEN = 32
+CODE_RE = re.compile(rf"[A-Za-z0-9_-]{{1,{CODE_MAX_LEN}}}")  # fullmatch bilan ishlatiladi
+URL_PREFIXES = ("http://", "https://")
+MOVIES_PER_PAGE = 60
+
+def title_html(title: str) -> str:
+    # Nom foydalanuvchi kiritgan matn — <, >, & bo'lsa HTML xabar buzilmasin
+    return html.escape(title)
 
 async def send_movie(message: Message, title: str, kind: str, payload: str):
+    safe_title = title_html(title)
     if kind == "link":
-        await message.answer(f"🎬 <b>{title}</b>\n🔗 {payload}", parse_mode="HTML")
+        await message.answer(f"🎬 <b>{safe_title}</b>\n🔗 {html.escape(payload)}", parse_mode="HTML")
         return
 
-    await message.answer(f"🎬 <b>{title}</b>\n✅ Kino topildi, yuboryapman...", parse_mode="HTML")
+    # Alohida "yuboryapman..." xabari yo'q — sarlavha video captionida
     try:
-        await message.answer_video(payload, caption=title)
+        await message.answer_video(payload, caption=f"🎬 <b>{safe_title}</b>", parse_mode="HTML")
     except Exception:
-        await message.answer(f"📎 File ID:\n<code>{payload}</code>", parse_mode="HTML")
+        await message.answer(f"🎬 <b>{safe_title}</b>\n📎 File ID:\n<code>{payload}</code>", parse_mode="HTML")
+
+
+def render_movie_pages(rows: List[Tuple[str, str]]) -> List[str]:
+    # Kod CODE_RE dan o'tgani uchun escape shart emas
+    lines = [f"{code} — {title_html(title)}" for code, title in rows]
+    return [
+        "📃 <b>Kinolar ro‘yxati:</b>\n" + "\n".join(lines[i:i + MOVIES_PER_PAGE])
+        for i in range(0, len(lines), MOVIES_PER_PAGE)
+    ]
+
+# Ro'yxatdagi nomlarda link bo'lsa ham Telegram preview yasamasin
+NO_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+# chat_id -> yuborilayotgan ro'yxat; tugma qayta-qayta bosilsa ro'yxat bir marta yuboriladi
+_list_sends: Dict[int, "asyncio.Future"] = {}
+
+async def send_movie_list(message: Message, pages: List[str]):
+    async def send_pages():
+        # Sahifalar tartibi buzilmasligi uchun ketma-ket yuboriladi
+        for page in pages:
+            await message.answer(page, parse_mode="HTML", link_preview_options=NO_PREVIEW)
+
+    await coalesce(_list_sends, message.chat.id, send_pages)
 
 
 # ======================
@@ -223,7 +400,7 @@ async def start_cmd(message: Message):
         return
 
     name = message.from_user.first_name if message.from_user else "Foydalanuvchi"
-    await message.answer(f'Salom, "{name}" kod yuborishingiz mumkin.', reply_markup=main_kb())
+    await message.answer(f'Salom, "{name}" kod yuborishingiz mumkin.', reply_markup=MAIN_KB)
 
 
 @dp.callback_query(F.data == "check_sub")
@@ -233,8 +410,9 @@ async def check_sub_cb(call: CallbackQuery):
         await call.answer("Xatolik", show_alert=True)
         return
 
-    if await is_subscribed(user_id):
-        await call.message.answer("✅ A’zo bo‘ldingiz. Endi botdan foydalanishingiz mumkin.", reply_markup=main_kb())
+    # Keshda a'zo bo'lsa API ga bormaymiz; "a'zo emas" bo'lsa qayta so'raymiz (hozirgina qo'shilgan bo'lishi mumkin)
+    if cached_subscription(user_id) or await is_subscribed(user_id, fresh=True):
+        await call.message.answer("✅ A’zo bo‘ldingiz. Endi botdan foydalanishingiz mumkin.", reply_markup=MAIN_KB)
         await call.answer()
     else:
         await call.answer("❌ Hali a’zo emassiz. Kanalga a’zo bo‘lib qayta tekshiring.", show_alert=True)
@@ -246,30 +424,20 @@ async def all_movies_cb(call: CallbackQuery):
         await call.message.answer(
             "❗ Avval kanalga a’zo bo‘ling. Request yuborsangiz bot avtomatik tasdiqlaydi.\n"
             "So‘ng ✅ Tekshirish bosing.",
-            reply_markup=join_kb()
+            reply_markup=JOIN_KB
         )
         await call.answer()
         return
 
-    rows = await list_movies()
-    if not rows:
+    pages = await movie_pages()
+    if not pages:
         await call.message.answer("Hali kino qo‘shilmagan.")
         await call.answer()
         return
 
-    lines = [f"{code} — {title}" for code, title in rows]
-    chunk = []
-    max_lines = 60
-
-    for line in lines:
-        chunk.append(line)
-        if len(chunk) >= max_lines:
-            await call.message.answer("📃 <b>Kinolar ro‘yxati:</b>\n" + "\n".join(chunk), parse_mode="HTML")
-            chunk = []
-    if chunk:
-        await call.message.answer("📃 <b>Kinolar ro‘yxati:</b>\n" + "\n".join(chunk), parse_mode="HTML")
-
+    # Avval callbackga javob — tugmadagi "soat" ro'yxat yuborilishini kutib turmasin
     await call.answer()
+    await send_movie_list(call.message, pages)
 
 
 # /kino — hamma qo‘sha oladi (lekin a'zo bo'lish shart)
@@ -287,7 +455,8 @@ async def add_movie_code(message: Message, state: FSMContext):
         return
 
     code = (message.text or "").strip()
-    if not CODE_RE.match(code):
+    # Uzunlikni tekshirish regexdan arzon — uzun matnlar darhol rad etiladi
+    if len(code) > CODE_MAX_LEN or not CODE_RE.fullmatch(code):
         await message.answer("Kod noto‘g‘ri. Faqat harf/raqam/_/- ishlating, 1–32 belgi.")
         return
 
@@ -321,41 +490,40 @@ async def add_movie_content(message: Message, state: FSMContext):
     if not await require_subscribed(message):
         return
 
+    # Avval xabar turini aniqlaymiz — yaroqsiz xabarda FSM storagega bormaymiz
+    text = (message.text or "").strip()
+    is_link = text.startswith(URL_PREFIXES)
+    if not is_link and not message.video:
+        await message.answer("Link (https://...) yoki video yuboring.")
+        return
+
     data = await state.get_data()
     code = data["code"]
     title = data["title"]
 
-    text = (message.text or "").strip()
-
     # Link
-    if text.startswith("http://") or text.startswith("https://"):
+    if is_link:
         await upsert_movie(code, title, "link", text)
         await state.clear()
-        await message.answer(f"✅ Saqlandi!\nKod: {code}\nNomi: {title}\nTuri: link", reply_markup=main_kb())
+        await message.answer(f"✅ Saqlandi!\nKod: {code}\nNomi: {title}\nTuri: link", reply_markup=MAIN_KB)
         return
 
     # Video
-    if message.video:
-        file_id = message.video.file_id
-        await upsert_movie(code, title, "telegram", file_id)
-        await state.clear()
-        await message.answer(f"✅ Saqlandi!\nKod: {code}\nNomi: {title}\nTuri: telegram(video)", reply_markup=main_kb())
-        return
-
-    await message.answer("Link (https://...) yoki video yuboring.")
+    file_id = message.video.file_id
+    await upsert_movie(code, title, "telegram", file_id)
+    await state.clear()
+    await message.answer(f"✅ Saqlandi!\nKod: {code}\nNomi: {title}\nTuri: telegram(video)", reply_markup=MAIN_KB)
 
 
-# Kod yuborsa kino chiqaradi (a'zo bo'lish shart)
-@dp.message()
+# Kod yuborsa kino chiqaradi (a'zo bo'lish shart).
+# Filtr router darajasida: kodga o'xshamagan xabarlar handlerga ham kelmaydi
+@dp.message(F.text.regexp(CODE_RE, mode="fullmatch"))
 async def handle_codes(message: Message):
     if not await require_subscribed(message):
         return
 
-    text = (message.text or "").strip()
-    if not text:
-        return
-
-    row = await get_movie(text)
+    # Filtr (CODE_RE fullmatch) matn bo'sh emas va bo'shliqsiz kod ekanini kafolatlaydi
+    row = await get_movie(message.text)
     if not row:
         return
 
@@ -374,10 +542,13 @@ async def main():
     except Exception as e:
         print(f"[WARN] delete_webhook ishlamadi: {e}")
 
+    # Handlerlar ishga tushgandan keyin o'zgarmaydi — bir marta hisoblaymiz
+    allowed_updates = dp.resolve_used_update_types()
+
     try:
         while True:
             try:
-                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+                await dp.start_polling(bot, allowed_updates=allowed_updates)
             except TelegramNetworkError as e:
                 print(f"[NET] {e} -> 5 soniyada qayta ulanaman...")
                 await asyncio.sleep(5)
@@ -393,6 +564,9 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass